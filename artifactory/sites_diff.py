@@ -5,13 +5,22 @@
 # 2. Checks for differences between artifacts.
 
 import argparse
-import json
 import logging
 import sys
-from typing import Any
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Optional
 
+import ijson
+import orjson
 import requests
-from requests.exceptions import HTTPError
+from urllib3.util.retry import Retry
+
+# This script is run directly rather than as a module; make the shared `common` package importable.
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from common.http import MAX_WORKERS, loads, make_session, raise_for_status  # noqa: E402
 
 
 logging.basicConfig(
@@ -20,119 +29,208 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-def _raise_for_status(response: requests.Response) -> None:
-    try:
-        response.raise_for_status()
-    except HTTPError:
-        try:
-            response_text = response.text
-        except:
-            response_text = "<unknown>"
-        logger.error("Erronous response encountered and will be re-raised; response text: %s", response_text)
-        raise
-
-
 def _auth_header(token: str) -> dict[str, str]:
     return dict(Authorization=f"Bearer {token}")
 
 
+def _item_uri(item: dict[str, Any]) -> str:
+    # Items at the repository root have a path of "."; URIs are reported relative to the repository root.
+    if item["path"] == ".":
+        return f"/{item['name']}"
+    return f"/{item['path']}/{item['name']}"
+
+
+def _checksums_differ(checksums_1: tuple[str, Optional[str]], checksums_2: tuple[str, Optional[str]]) -> bool:
+    sha1_1, sha256_1 = checksums_1
+    sha1_2, sha256_2 = checksums_2
+    if sha1_1 != sha1_2:
+        return True
+    # SHA-256 is missing for items stored before it was calculated, typically on the source site only.
+    return sha256_1 is not None and sha256_2 is not None and sha256_1 != sha256_2
+
+
 def diff(
         url_1: str,
         url_2: str,
         token_1: str,
         token_2: str,
         exclude_artifacts: bool,
+        skip_unchanged_repositories: bool,
         **_):
-    def _repository_keys(url: str, token: str) -> dict[str, dict[str, Any]]:
-        response = requests.get(
-                f"{url}/artifactory/api/repositories",
-                headers=_auth_header(token),
+    def _repository_keys(session: requests.Session, url: str) -> dict[str, dict[str, Any]]:
+        response = session.get(f"{url}/artifactory/api/repositories")
+        raise_for_status(response)
+        return {item["key"]: item for item in loads(response)}
+
+    def _list_items(
+            session: requests.Session, url: str, repository: str) -> dict[str, tuple[str, Optional[str]]]:
+        # AQL returns only the fields that are compared, rather than the full storage listing of each item.
+        query = (
+            f'items.find({{"repo": {orjson.dumps(repository).decode()}, "type": "file"}})'
+            '.include("repo", "path", "name", "actual_sha1", "sha256")'
         )
-        _raise_for_status(response)
-        return {item["key"]: item for item in response.json()}
-
-    def _list_items(url: str, token: str, repository: str) -> dict[str, dict[str, Any]]:
-        response = requests.get(
-                f"{url}/artifactory/api/storage/{repository}?list",
-                params={
-                    "deep"           : 1,
-                    "listFolders"    : 0,
-                    "mdTimestamps"   : 0,
-                    "includeRootPath": 0
-                },
-                headers=_auth_header(token))
-        _raise_for_status(response)
-        return {item["uri"]: item for item in response.json()["files"]}
-
-    def _repository_details(url: str, token: str, key: str) -> dict[str, Any]:
-        response = requests.get(
-                f"{url}/artifactory/api/repositories/{key}",
-                headers=_auth_header(token))
-        _raise_for_status(response)
-        return response.json()
-
-    repositories_1 = _repository_keys(url_1, token_1)
-    repositories_2 = _repository_keys(url_2, token_2)
-
-    repositories_1_keys = set(repositories_1.keys())
-    repositories_2_keys = set(repositories_2.keys())
-    missing_in_1 = repositories_2_keys - repositories_1_keys
-    missing_in_2 = repositories_1_keys - repositories_2_keys
-    exists_in_both = repositories_1_keys.intersection(repositories_2_keys)
-    rclass_mismatch: list[str] = []
-    package_type_mismatch: list[str] = []
-    virtual_composition_mismatch: list[str] = []
-
-    for key in missing_in_1:
-        logger.info("Repository exists in site 2 and missing in site 1: %s", key)
-    for key in missing_in_2:
-        logger.info("Repository exists in site 1 and missing in site 2: %s", key)
-    for key in exists_in_both:
-        rclass_1 = repositories_1[key]["type"]
-        rclass_2 = repositories_2[key]["type"]
-        if rclass_1 != rclass_2:
-            logger.info("Repository %s is of type %s on site 1, but %s on site 2", key, rclass_1, rclass_2)
-            rclass_mismatch.append(key)
-        package_type_1 = repositories_1[key]["packageType"]
-        package_type_2 = repositories_2[key]["packageType"]
-        if package_type_1 != package_type_2:
-            logger.info("Repository %s is of package type %s on site 1, but %s on site 2", key, package_type_1, package_type_2)
-            package_type_mismatch.append(key)
-        if rclass_1 == "VIRTUAL":
-            repo_details_1 = _repository_details(url_1, token_1, key)
-            repo_details_2 = _repository_details(url_2, token_2, key)
-            if repo_details_1["repositories"] != repo_details_2["repositories"]:
-                logger.info("Virtual repository %s has a different repository composition between the two sites", key)
-                virtual_composition_mismatch.append(key)
-
-    artifacts_report = None
-    if not exclude_artifacts:
-        artifacts_report = {}
+        with session.post(
+                f"{url}/artifactory/api/search/aql",
+                data=query,
+                headers={"Content-Type": "text/plain"},
+                stream=True) as response:
+            raise_for_status(response)
+            # Results for large repositories can be huge; parse them incrementally off the socket and
+            # only retain the checksums needed for comparison. urllib3 decompresses the stream chunk by
+            # chunk as ijson reads it.
+            response.raw.decode_content = True
+            items: dict[str, tuple[str, Optional[str]]] = {}
+            item: dict[str, Any] = {}
+            query_range: dict[str, Any] = {}
+            for prefix, event, value in ijson.parse(response.raw):
+                if prefix.startswith("results.item."):
+                    item[prefix[len("results.item."):]] = value
+                elif prefix == "results.item" and event == "end_map":
+                    # Items stored before SHA-256 was calculated come back without one.
+                    items[_item_uri(item)] = (item["actual_sha1"], item.get("sha256"))
+                    item = {}
+                elif prefix.startswith("range."):
+                    query_range[prefix[len("range."):]] = value
+        # The query sets no limit of its own, so a limit in the range is the server's query limit for
+        # non-admin users (artifactory.search.userQueryLimit). Missing results would otherwise be reported as
+        # missing artifacts.
+        if query_range.get("limited") or ("limit" in query_range and query_range["total"] >= query_range["limit"]):
+            raise Exception(
+                    f"AQL results for repository {repository} on {url} were truncated at {len(items)} items; "
+                    f"use a token of an admin user, or raise artifactory.search.userQueryLimit")
+        return items
+
+    def _repository_details(session: requests.Session, url: str, key: str) -> dict[str, Any]:
+        response = session.get(f"{url}/artifactory/api/repositories/{key}")
+        raise_for_status(response)
+        return loads(response)
+
+    def _files_counts(session: requests.Session, url: str) -> Optional[dict[str, int]]:
+        response = session.get(f"{url}/artifactory/api/storageinfo")
+        # Storage info is restricted to admins; without it, fall back to comparing every repository.
+        if response.status_code in (401, 403):
+            logger.warning(
+                    "Storage info of %s is not accessible with the given token; all repositories will be compared", url)
+            return None
+        raise_for_status(response)
+        return {item["repoKey"]: item["filesCount"] for item in loads(response)["repositoriesSummaryList"]}
+
+    def _repository_signature(
+            session: requests.Session,
+            url: str,
+            files_counts: dict[str, int],
+            key: str) -> Optional[tuple[int, datetime]]:
+        files_count = files_counts.get(key)
+        if files_count is None:
+            return None
+        response = session.get(f"{url}/artifactory/api/storage/{key}?lastModified")
+        # Empty repositories have no last modified item.
+        if response.status_code == 404:
+            return None
+        raise_for_status(response)
+        # Compare instants rather than strings; sites format the time in their own timezone (e.g. "+02:00" vs. "Z").
+        last_modified: str = loads(response)["lastModified"]
+        # datetime.fromisoformat() only accepts a "Z" suffix from Python 3.11 on.
+        if last_modified.endswith("Z"):
+            last_modified = last_modified[:-1] + "+00:00"
+        return files_count, datetime.fromisoformat(last_modified)
+
+    def _compare_repository(
+            s1: requests.Session,
+            s2: requests.Session,
+            key: str,
+            files_counts_1: Optional[dict[str, int]],
+            files_counts_2: Optional[dict[str, int]]) -> tuple[str, dict[str, list[str]]]:
+        if files_counts_1 is not None and files_counts_2 is not None:
+            signature_1 = _repository_signature(s1, url_1, files_counts_1, key)
+            if signature_1 is not None and signature_1 == _repository_signature(s2, url_2, files_counts_2, key):
+                logger.info("Skipping repository with matching file count and last modification time: %s", key)
+                return key, {}
+        logger.info("Comparing repository: %s", key)
+        repository_report: dict[str, list[str]] = {}
+        items_in_1 = _list_items(s1, url_1, key)
+        items_in_2 = _list_items(s2, url_2, key)
+        # A single pass over each listing, rather than two set differences plus a scan for checksum diffs.
+        missing_in_2_uris: list[str] = []
+        diffs: list[str] = []
+        for uri, checksums in items_in_1.items():
+            other_checksums = items_in_2.get(uri)
+            if other_checksums is None:
+                missing_in_2_uris.append(uri)
+            elif _checksums_differ(checksums, other_checksums):
+                diffs.append(uri)
+        missing_in_1_uris = [uri for uri in items_in_2 if uri not in items_in_1]
+        if missing_in_1_uris:
+            repository_report["missing_in_1"] = missing_in_1_uris
+        if missing_in_2_uris:
+            repository_report["missing_in_2"] = missing_in_2_uris
+        if diffs:
+            repository_report["diffs"] = diffs
+        return key, repository_report
+
+    # AQL searches are POSTs; every POST made here only reads, so it's safe to retry.
+    allowed_methods = Retry.DEFAULT_ALLOWED_METHODS | {"POST"}
+    with make_session(_auth_header(token_1), allowed_methods) as s1, \
+            make_session(_auth_header(token_2), allowed_methods) as s2:
+        repositories_1 = _repository_keys(s1, url_1)
+        repositories_2 = _repository_keys(s2, url_2)
+
+        # A single pass over each site's repositories, rather than two set differences plus an intersection.
+        missing_in_2: list[str] = []
+        exists_in_both: list[str] = []
+        for key in repositories_1:
+            if key in repositories_2:
+                exists_in_both.append(key)
+            else:
+                missing_in_2.append(key)
+        missing_in_1 = [key for key in repositories_2 if key not in repositories_1]
+        rclass_mismatch: list[str] = []
+        package_type_mismatch: list[str] = []
+        virtual_composition_mismatch: list[str] = []
+
+        for key in missing_in_1:
+            logger.info("Repository exists in site 2 and missing in site 1: %s", key)
+        for key in missing_in_2:
+            logger.info("Repository exists in site 1 and missing in site 2: %s", key)
         for key in exists_in_both:
-            if repositories_1[key]["type"] in {"VIRTUAL", "REMOTE"}:
-                continue
-            logger.info("Comparing repository: %s", key)
-
-            def _artifacts_report() -> dict:
-                return artifacts_report.setdefault(key, {})
-
-            items_in_1 = _list_items(url_1, token_1, key)
-            items_in_2 = _list_items(url_2, token_2, key)
-            items_in_1_uris = set(items_in_1.keys())
-            items_in_2_uris = set(items_in_2.keys())
-            missing_in_1_uris = items_in_2_uris - items_in_1_uris
-            missing_in_2_uris = items_in_1_uris - items_in_2_uris
-            if missing_in_1_uris:
-                _artifacts_report()["missing_in_1"] = list(missing_in_1_uris)
-            if missing_in_2_uris:
-                _artifacts_report()["missing_in_2"] = list(missing_in_2_uris)
-            items_existing_in_both = items_in_1_uris.intersection(items_in_2_uris)
-
-            for uri in items_existing_in_both:
-                item_in_1 = items_in_1[uri]
-                item_in_2 = items_in_2[uri]
-                if item_in_1["sha1"] != item_in_2["sha1"] or item_in_1["sha2"] != item_in_2["sha2"]:
-                    _artifacts_report().setdefault("diffs", []).append(uri)
+            rclass_1 = repositories_1[key]["type"]
+            rclass_2 = repositories_2[key]["type"]
+            if rclass_1 != rclass_2:
+                logger.info("Repository %s is of type %s on site 1, but %s on site 2", key, rclass_1, rclass_2)
+                rclass_mismatch.append(key)
+            package_type_1 = repositories_1[key]["packageType"]
+            package_type_2 = repositories_2[key]["packageType"]
+            if package_type_1 != package_type_2:
+                logger.info("Repository %s is of package type %s on site 1, but %s on site 2", key, package_type_1, package_type_2)
+                package_type_mismatch.append(key)
+            if rclass_1 == "VIRTUAL":
+                repo_details_1 = _repository_details(s1, url_1, key)
+                repo_details_2 = _repository_details(s2, url_2, key)
+                if repo_details_1["repositories"] != repo_details_2["repositories"]:
+                    logger.info("Virtual repository %s has a different repository composition between the two sites", key)
+                    virtual_composition_mismatch.append(key)
+
+        artifacts_report = None
+        if not exclude_artifacts:
+            artifacts_report = {}
+            comparable_keys = [key for key in exists_in_both
+                               if repositories_1[key]["type"] not in {"VIRTUAL", "REMOTE"}]
+            files_counts_1 = files_counts_2 = None
+            if skip_unchanged_repositories:
+                files_counts_1 = _files_counts(s1, url_1)
+                files_counts_2 = _files_counts(s2, url_2)
+            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+                futures = [executor.submit(_compare_repository, s1, s2, key, files_counts_1, files_counts_2)
+                           for key in comparable_keys]
+                for future in as_completed(futures):
+                    try:
+                        key, repository_report = future.result()
+                    except Exception:
+                        # Don't wait for the remaining (possibly thousands of) listings before failing.
+                        executor.shutdown(cancel_futures=True)
+                        raise
+                    if repository_report:
+                        artifacts_report[key] = repository_report
 
     repositories_report = {}
     report = {
@@ -143,10 +241,10 @@ def diff(
     # Only include if items of concern exist.
 
     if missing_in_1:
-        repositories_report["missing_in_1"] = list(missing_in_1)
+        repositories_report["missing_in_1"] = missing_in_1
 
     if missing_in_2:
-        repositories_report["missing_in_2"] = list(missing_in_2)
+        repositories_report["missing_in_2"] = missing_in_2
 
     if rclass_mismatch:
         repositories_report["rclass_mismatch"] = rclass_mismatch
@@ -157,7 +255,7 @@ def diff(
     if virtual_composition_mismatch:
         repositories_report["virtual_composition_mismatch"] = virtual_composition_mismatch
 
-    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.buffer.write(orjson.dumps(report, option=orjson.OPT_INDENT_2))
 
 
 def main():
@@ -170,6 +268,11 @@ def main():
     parser.add_argument("--token-2", required=True, metavar="token", help="Identity / Access token for site 2")
 
     parser.add_argument("--exclude-artifacts", action="store_true", help="Exclude artifacts comparison", default=False)
+    parser.add_argument(
+            "--skip-unchanged-repositories", action="store_true", default=False,
+            help="Skip artifacts comparison of repositories whose file count and last modification time match on both "
+                 "sites. File counts are read from /api/storageinfo on both sites, which requires an admin token; "
+                 "without access to it, all repositories are compared")
 
     args = parser.parse_args()
     diff(**vars(args))
@@ -0,0 +1,68 @@
+import logging
+from typing import Any, Collection
+
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+# Number of requests issued concurrently by the scripts; kept below the HTTP connection pool size so
+# that workers don't wait on each other for a connection.
+MAX_WORKERS = 32
+POOL_MAXSIZE = 64
+
+
+class _CreatingPostRetry(Retry):
+    # A POST that creates something is only repeated when it was rejected by rate limiting, in which case nothing
+    # was created; after any other error status it may have taken effect.
+    def is_retry(self, method: str, status_code: int, has_retry_after: bool = False) -> bool:
+        if method.upper() == "POST" and status_code != 429:
+            return False
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+def make_session(
+        headers: dict[str, str],
+        allowed_methods: Collection[str] = Retry.DEFAULT_ALLOWED_METHODS,
+        creating_posts: bool = False) -> requests.Session:
+    session = requests.Session()
+    session.headers.update(headers)
+    # Back off exponentially on rate limiting and transient server errors. Only the given methods are
+    # retried; callers whose POSTs create things pass creating_posts instead of allowing POST.
+    retry_type: type[Retry] = Retry
+    read_retries = None
+    if creating_posts:
+        retry_type = _CreatingPostRetry
+        allowed_methods = frozenset(allowed_methods) | {"POST"}
+        # A read error means the request was sent and may have been processed; never repeat it.
+        read_retries = 0
+    retry = retry_type(
+            total=5,
+            read=read_retries,
+            backoff_factor=1,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=allowed_methods,
+            raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=16, max_retries=retry, pool_maxsize=POOL_MAXSIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def raise_for_status(response: requests.Response) -> None:
+    if response.status_code < 400:
+        return
+    # Decoding the body of a (potentially large) error response is only worth it if it's going to be logged.
+    if logger.isEnabledFor(logging.ERROR):
+        try:
+            response_text = response.text
+        except:
+            response_text = "<unknown>"
+        logger.error("Erronous response encountered and will be re-raised; response text: %s", response_text)
+    response.raise_for_status()
+
+
+def loads(response: requests.Response) -> Any:
+    return orjson.loads(response.content)
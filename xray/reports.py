@@ -1,48 +1,60 @@
 import argparse
-import json
 import logging
+import os
+import shutil
 import sys
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from functools import partial
 from pathlib import Path
-from typing import Any, Generator
+from typing import Any, Callable, Generator
 
+import orjson
 import requests
-from requests.exceptions import HTTPError
+from urllib3.util.retry import Retry
+
+# Put the repository root on the path, so that `common` resolves when run as `python xray/reports.py`.
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from common.http import MAX_WORKERS, loads, make_session, raise_for_status  # noqa: E402
 
 logging.basicConfig(
         format="%(asctime)s %(levelname)-8s %(message)s", stream=sys.stderr, level=logging.INFO)
 
 logger = logging.getLogger(__name__)
 
+# Report type of an exported definition, mapped to the URI path element used for creating it.
+_URI_TYPES = {
+    "license"         : "licenses",
+    "vulnerability"   : "vulnerabilities",
+    "operational_risk": "operationalRisks",
+}
+
+# Listing report summaries is a POST; it only reads, so it's safe to retry. Sessions that create reports use
+# make_session(creating_posts=True) instead.
+_READ_ONLY_ALLOWED_METHODS = Retry.DEFAULT_ALLOWED_METHODS | {"POST"}
 
-def _raise_for_status(response: requests.Response) -> None:
-    try:
-        response.raise_for_status()
-    except HTTPError:
-        try:
-            response_text = response.text
-        except:
-            response_text = "<unknown>"
-        logger.error("Erronous response encountered and will be re-raised; response text: %s", response_text)
-        raise
 
+def _headers(token: str) -> dict[str, str]:
+    return {
+        "Authorization": f"Bearer {token}",
+        "Accept"       : "application/json",
+    }
 
-def _report_summaries_generator(url: str, token: str) -> Generator[tuple[int, str, dict[str, Any]], None, None]:
+
+def _report_summaries_generator(
+        session: requests.Session, url: str) -> Generator[tuple[int, str, dict[str, Any]], None, None]:
     page_num = 1
     while True:
-        response = requests.post(
+        response = session.post(
                 f"{url}/xray/api/v1/reports",
                 params={
                     "direction"  : "asc",
                     "page_num"   : page_num,
                     "num_of_rows": 10,
                     "order_by"   : "name"
-                },
-                headers={
-                    "Authorization": f"Bearer {token}",
-                    "Accept"       : "application/json",
                 })
-        _raise_for_status(response)
-        result = response.json()
+        raise_for_status(response)
+        result = loads(response)
         reports = result.get("reports", [])
         if not reports:
             break
@@ -51,28 +63,89 @@ def _report_summaries_generator(url: str, token: str) -> Generator[tuple[int, st
         page_num += 1
 
 
+def _export_definition(
+        session: requests.Session,
+        url: str,
+        output_dir: Path,
+        report_id: int,
+        report_name: str,
+        definition: dict[str, Any]) -> None:
+    summary_output_path = output_dir.joinpath(f"{report_id}-summary.json")
+    logger.info("Exporting summary of report '%s' (ID: %d) to %s", report_name, report_id, summary_output_path)
+    summary_output_path.write_bytes(orjson.dumps(definition, option=orjson.OPT_INDENT_2))
+    details_output_path = output_dir.joinpath(f"{report_id}-details.json")
+    logger.info("Exporting definition of report '%s' (ID: %d) to %s", report_name, report_id, details_output_path)
+    response = session.get(f"{url}/xray/api/v1/reports/{report_id}")
+    raise_for_status(response)
+    details = response.content
+    # Write the response through as-is when it's already pretty-printed; only re-format compact JSON.
+    if b"\n  " not in details[:128]:
+        details = orjson.dumps(orjson.loads(details), option=orjson.OPT_INDENT_2)
+    details_output_path.write_bytes(details)
+
+
+def _export_reports(
+        session: requests.Session, url: str, export_report: Callable[[int, str, dict[str, Any]], None]) -> None:
+    failed_report_ids: list[int] = []
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures: dict[Future, int] = {}
+        try:
+            # Summary pages keep being fetched while earlier reports are exported.
+            for report_id, report_name, definition in _report_summaries_generator(session, url):
+                futures[executor.submit(export_report, report_id, report_name, definition)] = report_id
+        finally:
+            # Also reached when fetching a summary page fails, so that failures of reports submitted
+            # until then are still reported.
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception:
+                    # Keep exporting the remaining reports; failures are reported once all are done.
+                    logger.exception("Failed exporting report (ID: %d)", futures[future])
+                    failed_report_ids.append(futures[future])
+            if failed_report_ids:
+                logger.error(
+                        "Failed exporting %d report(s): %s", len(failed_report_ids), sorted(failed_report_ids))
+    if failed_report_ids:
+        raise Exception(f"Failed exporting {len(failed_report_ids)} report(s); see the log for details")
+
+
 def export_definitions(
         url: str,
         token: str,
         output_dir: Path,
         **_):
     output_dir.mkdir(parents=True, exist_ok=True)
-    for report_id, report_name, definition in _report_summaries_generator(url, token):
-        summary_output_path = output_dir.joinpath(f"{report_id}-summary.json")
-        logger.info("Exporting summary of report '%s' (ID: %d) to %s", report_name, report_id, summary_output_path)
-        with summary_output_path.open("w", encoding="UTF-8") as f:
-            json.dump(definition, f, indent=2)
-        details_output_path = output_dir.joinpath(f"{report_id}-details.json")
-        logger.info("Exporting definition of report '%s' (ID: %d) to %s", report_name, report_id, details_output_path)
-        response = requests.get(
-                f"{url}/xray/api/v1/reports/{report_id}",
-                headers={
-                    "Authorization": f"Bearer {token}",
-                    "Accept"       : "application/json",
-                })
-        _raise_for_status(response)
-        with details_output_path.open("w", encoding="utf-8") as f:
-            json.dump(response.json(), f, indent=2)
+    with make_session(_headers(token), allowed_methods=_READ_ONLY_ALLOWED_METHODS) as session:
+        _export_reports(session, url, partial(_export_definition, session, url, output_dir))
+
+
+def _iter_json_files(root: Path) -> Generator[Path, None, None]:
+    # os.scandir() exposes the entry type from the directory listing itself, sparing a stat() per entry.
+    pending = [str(root)]
+    while pending:
+        with os.scandir(pending.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                elif entry.name.endswith(".json") and entry.is_file():
+                    yield Path(entry.path)
+
+
+def _import_definition(session: requests.Session, url: str, definition_file: Path) -> None:
+    logger.info("Importing definition: %s", definition_file)
+    with definition_file.open("rb") as f:
+        definition = orjson.loads(f.read())
+    report_type = definition["report_type"]
+    uri_type = _URI_TYPES.get(report_type)
+    if uri_type is None:
+        raise Exception(f"Unrecognized report type: {report_type}")
+    response = session.post(
+            f"{url}/xray/api/v1/reports/{uri_type}",
+            headers={"Content-Type": "application/json"},
+            data=orjson.dumps(definition)
+    )
+    raise_for_status(response)
 
 
 def import_definitions(
@@ -83,28 +156,51 @@ def import_definitions(
     if not input_dir.is_dir():
         raise Exception(f"Path is not a directory or doesn't exist: {input_dir}")
 
-    for definition_file in input_dir.rglob("*.json"):
-        logger.info("Importing definition: %s", definition_file)
-        with definition_file.open("r", encoding="UTF-8") as f:
-            definition = json.load(f)
-        report_type = definition["report_type"]
-        if report_type == "license":
-            uri_type = "licenses"
-        elif report_type == "vulnerability":
-            uri_type = "vulnerabilities"
-        elif report_type == "operational_risk":
-            uri_type = "operationalRisks"
-        else:
-            raise Exception(f"Unrecognized report type: {report_type}")
-        response = requests.post(
-                f"{url}/xray/api/v1/reports/{uri_type}",
-                headers={
-                    "Authorization": f"Bearer {token}",
-                    "Accept"       : "application/json",
-                },
-                json=definition
-        )
-        _raise_for_status(response)
+    failed_definition_files: list[Path] = []
+    # Concurrent imports are likely to hit Xray's rate limiting; have rejected creations retried.
+    with make_session(_headers(token), creating_posts=True) as session, \
+            ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {
+            executor.submit(_import_definition, session, url, definition_file): definition_file
+            for definition_file in _iter_json_files(input_dir)
+        }
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception:
+                # Keep importing the remaining definitions; failures are reported once all are done.
+                logger.exception("Failed importing definition: %s", futures[future])
+                failed_definition_files.append(futures[future])
+    if failed_definition_files:
+        raise Exception(
+                f"Failed importing {len(failed_definition_files)} definition(s): "
+                f"{sorted(str(path) for path in failed_definition_files)}")
+
+
+def _export_contents(
+        session: requests.Session,
+        url: str,
+        output_dir: Path,
+        report_format: str,
+        report_id: int,
+        report_name: str,
+        definition: dict[str, Any]) -> None:
+    output_path = output_dir.joinpath(f"{report_id}-{report_name}.zip")
+    logger.info(
+            "Exporting results of report '%s' (ID: %d) to %s (format: %s)", report_name, report_id,
+            output_path, report_format)
+    with session.get(
+            f"{url}/xray/api/v1/reports/export/{report_id}",
+            headers={"Accept": "application/zip"},
+            params={
+                "file_name": f"{report_id}-{report_name}",
+                "format"   : report_format
+            },
+            stream=True) as r:
+        raise_for_status(r)
+        r.raw.decode_content = True
+        with output_path.open(mode="wb") as f:
+            shutil.copyfileobj(r.raw, f, length=1024 * 1024)
 
 
 def export_contents(
@@ -114,26 +210,8 @@ def export_contents(
         report_format: str,
         **_):
     output_dir.mkdir(parents=True, exist_ok=True)
-    for report_id, report_name, definition in _report_summaries_generator(url, token):
-        output_path = output_dir.joinpath(f"{report_id}-{report_name}.zip")
-        logger.info(
-                "Exporting results of report '%s' (ID: %d) to %s (format: %s)", report_name, report_id,
-                output_path, report_format)
-        with requests.get(
-                f"{url}/xray/api/v1/reports/export/{report_id}",
-                headers={
-                    "Authorization": f"Bearer {token}",
-                    "Accept"       : "application/zip"
-                },
-                params={
-                    "file_name": f"{report_id}-{report_name}",
-                    "format"   : report_format
-                },
-                stream=True) as r:
-            _raise_for_status(r)
-            with output_path.open(mode="wb") as f:
-                for chunk in r.iter_content(chunk_size=None):
-                    f.write(chunk)
+    with make_session(_headers(token), allowed_methods=_READ_ONLY_ALLOWED_METHODS) as session:
+        _export_reports(session, url, partial(_export_contents, session, url, output_dir, report_format))
 
 
 def main():